@@ -1,32 +1,58 @@
 from datetime import datetime
-from geopy.distance import geodesic
+import numpy as np
 
-def calculate_distance(user_coords, hospital_coords):
-    """Tính khoảng cách (km) giữa 2 tọa độ."""
-    return geodesic(user_coords, hospital_coords).km
+try:
+    from fast_haversine import haversine_to_anchor, warm_up as _warm_up_kernel
+except ImportError:  # Chưa cài numba: dùng bản NumPy bên dưới
+    haversine_to_anchor = None
+    _warm_up_kernel = None
 
-def calculate_ai_score(distance, user, radius_km):
+EARTH_RADIUS_KM = 6371.0
+
+def haversine_km(lats, lngs, hospital_lat, hospital_lng):
+    """
+    Tính khoảng cách (km) từ cả mảng tọa độ tới một điểm, vector hóa bằng NumPy.
+    Kết quả giữ dtype của lats (float32 từ donor_cache).
+    """
+    ftype = lats.dtype.type
+    lat1 = np.radians(lats)
+    lng1 = np.radians(lngs)
+    hlat_rad = np.radians(ftype(hospital_lat))
+    hlng_rad = np.radians(ftype(hospital_lng))
+    dlat = lat1 - hlat_rad
+    dlng = lng1 - hlng_rad
+    a = np.sin(dlat / 2) ** 2 + np.cos(hlat_rad) * np.cos(lat1) * np.sin(dlng / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+def warm_up():
+    """Biên dịch trước kernel Numba (nếu có) để request đầu tiên không phải chờ JIT."""
+    if _warm_up_kernel is not None:
+        _warm_up_kernel()
+
+def calculate_ai_scores(distances, days_since_donation, radius_km):
     """
-    Tính điểm phù hợp (0-1) cho người dùng dựa trên nhiều yếu tố.
+    Tính điểm phù hợp (0-1) cho cả mảng người dùng dựa trên nhiều yếu tố.
     - 40% từ khoảng cách
     - 30% từ lịch sử hiến máu
     - 30% từ thời gian phù hợp
+
+    days_since_donation là NaN với người chưa hiến bao giờ.
     """
     # 1. Điểm khoảng cách (càng gần điểm càng cao)
-    distance_score = max(0, 1 - (distance / radius_km))
+    distance_score = np.maximum(0, 1 - (distances / radius_km))
     
     # 2. Điểm lịch sử hiến máu (lần hiến cuối càng xa càng tốt)
-    if user.last_donation:
-        days_since_donation = (datetime.now().date() - user.last_donation).days
-        # Cần đợi ít nhất 84 ngày (12 tuần)
-        if days_since_donation < 84:
-            history_score = 0
-        else:
-            # Điểm tăng dần đến 180 ngày
-            history_score = min(1.0, (days_since_donation - 84) / (180 - 84))
-    else:
-        # Chưa hiến bao giờ = hoàn toàn sẵn sàng
-        history_score = 1.0
+    # Cần đợi ít nhất 84 ngày (12 tuần), điểm tăng dần đến 180 ngày.
+    # Chưa hiến bao giờ = hoàn toàn sẵn sàng
+    history_score = np.where(
+        np.isnan(days_since_donation),
+        1.0,
+        np.where(
+            days_since_donation < 84,
+            0.0,
+            np.minimum(1.0, (days_since_donation - 84) / (180 - 84))
+        )
+    )
     
     # 3. Điểm thời gian (giờ hành chính tốt hơn)
     current_hour = datetime.now().hour
@@ -40,27 +66,60 @@ def calculate_ai_score(distance, user, radius_km):
     )
     return final_score
 
-def filter_nearby_users(hospital, users, radius_km=10):
+def top_k_indices(keys, k):
+    """
+    Chỉ số của k phần tử có key nhỏ nhất, theo đúng thứ tự của một sort ổn định
+    (key tăng dần, bằng nhau thì giữ vị trí) nhưng không phải sort cả mảng:
+    argpartition chọn trong O(N), chỉ k phần tử được chọn mới được sort.
+    """
+    n = len(keys)
+    if k <= 0:
+        return np.empty(0, dtype=np.intp)
+    if k >= n:
+        return np.argsort(keys, kind='stable')
+    kth_value = keys[np.argpartition(keys, k - 1)[k - 1]]
+    below = np.flatnonzero(keys < kth_value)
+    # Các phần tử bằng giá trị thứ k: lấy theo vị trí, như sort ổn định
+    ties = np.flatnonzero(keys == kth_value)[:k - len(below)]
+    selected = np.concatenate([below, ties])
+    return selected[np.lexsort((selected, keys[selected]))]
+
+def filter_nearby_users(hospital, donors, radius_km=10, limit=50):
     """
     Lọc danh sách người dùng dựa trên khoảng cách tới bệnh viện và tính điểm AI.
+
+    donors là DonorArrays (các mảng id, lat, lng, last_donation) lấy từ donor_cache.
+
+    Returns:
+        Tuple (tổng số người trong bán kính, tối đa limit người điểm AI cao nhất
+        kèm khoảng cách và điểm, sắp xếp theo điểm AI giảm dần)
     """
-    hospital_coords = (hospital.lat, hospital.lng)
-    results = []
+    if len(donors.id) == 0:
+        return 0, []
     
-    for user in users:
-        user_coords = (user.lat, user.lng)
-        distance = calculate_distance(user_coords, hospital_coords)
-        
-        if distance <= radius_km:
-            score = calculate_ai_score(distance, user, radius_km)
-            results.append({
-                'user': user,
-                'distance': round(distance, 2),
-                'ai_score': round(score, 3)
-            })
+    ids, lats, lngs = donors.id, donors.lat, donors.lng
+    # Số ngày từ lần hiến cuối, NaN nếu chưa hiến bao giờ (ordinal = 0)
+    days = np.where(
+        donors.last_donation > 0,
+        datetime.now().date().toordinal() - donors.last_donation,
+        np.nan
+    )
     
-    # Sắp xếp kết quả theo điểm AI giảm dần
-    results.sort(key=lambda x: x['ai_score'], reverse=True)
+    if haversine_to_anchor is not None:
+        distances = haversine_to_anchor(lats, lngs, hospital.lat, hospital.lng, np.empty_like(lats))
+    else:
+        distances = haversine_km(lats, lngs, hospital.lat, hospital.lng)
+    within = distances <= radius_km
+    ids, distances, days = ids[within], distances[within], days[within]
     
-    return results
-
+    scores = np.round(calculate_ai_scores(distances, days, radius_km), 3)
+    # Chỉ nâng lên float64 khi làm tròn để hiển thị (float32 1.04 -> 1.0399999...)
+    distances = np.round(distances.astype(np.float64), 2)
+    
+    # Lấy top theo điểm AI giảm dần (giữ thứ tự khi bằng điểm), không sort cả danh sách
+    order = top_k_indices(-scores, limit)
+    
+    return len(ids), [
+        {'id': int(ids[i]), 'distance': float(distances[i]), 'ai_score': float(scores[i])}
+        for i in order
+    ]
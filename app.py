@@ -1,15 +1,55 @@
 from flask import Flask, request, jsonify
+from flask.json.provider import JSONProvider
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
-from datetime import datetime
+from datetime import date, datetime, timedelta
 from flask_cors import CORS
-from dateutil.parser import parse
+from celery import Celery
+from cachetools import LRUCache, TTLCache
+import bcrypt
+from requests.exceptions import RequestException
+import orjson
+import hashlib
+import hmac
+import math
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import unicodedata
+from sqlalchemy import bindparam, event, inspect as sa_inspect, select, text, update, or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+import donor_cache
+
+# Import bộ lọc AI một lần lúc khởi động (kéo theo numpy/numba), không import lại mỗi request
+try:
+    from ai_filter import filter_nearby_users, warm_up as warm_up_ai_filter
+except ImportError:
+    filter_nearby_users = None
 
 # Import geocoding MIỄN PHÍ
-from geocoding_free import geocode_address
+from geocoding_free import geocode_address, geocode_many
 
 # --- Khởi tạo và Cấu hình ---
+
+class OrjsonProvider(JSONProvider):
+    """Dùng orjson cho jsonify và request.get_json() (nhanh hơn nhiều so với json chuẩn)."""
+    option = orjson.OPT_NAIVE_UTC | orjson.OPT_SERIALIZE_NUMPY
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=self.option).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # Ghi thẳng bytes của orjson vào response, bỏ qua bước decode/encode str
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, option=self.option), mimetype='application/json')
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 cors = CORS(app, resources={r"/*": {"origins": "http://localhost:3000"}}, supports_credentials=True)
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///blood.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
@@ -18,14 +58,28 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
     'connect_args': {
         'timeout': 30,  # Tăng timeout lên 30 giây
-        'check_same_thread': False  # Cho phép nhiều thread truy cập
     },
-    'pool_pre_ping': True,  # Kiểm tra kết nối trước khi dùng
-    'pool_recycle': 3600,  # Recycle connection mỗi giờ
+    # Giữ kết nối mở giữa các request: đóng kết nối cuối cùng tới DB ở chế độ WAL
+    # buộc SQLite checkpoint rồi xóa file -wal/-shm, và PRAGMA phải chạy lại mỗi lần.
+    # QueuePool là mặc định của SQLAlchemy cho SQLite dạng file, ghi rõ để không bị đổi
+    'poolclass': QueuePool,
 }
 
 db = SQLAlchemy(app)
 migrate = Migrate(app, db)
+celery = Celery(app.name, broker='redis://localhost')
+
+# Bật WAL cho mỗi kết nối SQLite mới: người đọc (/users, /hospitals) không bị
+# chặn bởi người ghi, và synchronous=NORMAL giảm số lần fsync mỗi commit
+with app.app_context():
+    @event.listens_for(db.engine, "connect")
+    def set_sqlite_pragmas(dbapi_conn, connection_record):
+        cursor = dbapi_conn.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA busy_timeout=30000")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.close()
 
 
 # --- MODELS ---
@@ -40,6 +94,10 @@ class User(db.Model):
     address = db.Column(db.String(200), nullable=True)
     lat = db.Column(db.Float, nullable=True)
     lng = db.Column(db.Float, nullable=True)
+    # Vector đơn vị của (lat, lng), tự tính khi ghi (xem set_unit_vector)
+    x = db.Column(db.Float, nullable=True)
+    y = db.Column(db.Float, nullable=True)
+    z = db.Column(db.Float, nullable=True)
     blood_type = db.Column(db.String(5), nullable=True)
     last_donation = db.Column(db.Date, nullable=True)
 
@@ -57,27 +115,337 @@ class User(db.Model):
             'last_donation': self.last_donation.isoformat() if self.last_donation else None
         }
 
+# Các cột công khai của User (không có password) cho các truy vấn theo cột,
+# dựng dict bằng zip thay vì gọi to_dict() trên từng đối tượng ORM
+USER_COLS = (
+    User.id, User.name, User.phone, User.email, User.role, User.address,
+    User.lat, User.lng, User.blood_type, User.last_donation
+)
+_USER_KEYS = tuple(col.key for col in USER_COLS)
+
 class Hospital(db.Model):
     __tablename__ = 'hospitals'
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     lat = db.Column(db.Float, nullable=False)
     lng = db.Column(db.Float, nullable=False)
+    x = db.Column(db.Float, nullable=True)
+    y = db.Column(db.Float, nullable=True)
+    z = db.Column(db.Float, nullable=True)
 
     def to_dict(self):
          return {'id': self.id, 'name': self.name, 'lat': self.lat, 'lng': self.lng }
 
+    def unit_vector(self):
+        if self.x is not None:
+            return (self.x, self.y, self.z)
+        return donor_cache.unit_vector(self.lat, self.lng)
+
+@event.listens_for(User, 'before_insert')
+@event.listens_for(User, 'before_update')
+@event.listens_for(Hospital, 'before_insert')
+@event.listens_for(Hospital, 'before_update')
+def set_unit_vector(mapper, connection, target):
+    """Giữ x, y, z luôn khớp với lat/lng mỗi khi ghi qua ORM."""
+    target.x, target.y, target.z = donor_cache.unit_vector(target.lat, target.lng)
+
+# Cột thêm vào sau khi bảng đã có dữ liệu; db.create_all() không sửa bảng có sẵn
+UNIT_VECTOR_COLUMNS = ('x', 'y', 'z')
+
+def upgrade_unit_vector_columns():
+    """
+    Thêm cột x, y, z vào users/hospitals của blood.db tạo từ schema cũ rồi điền
+    giá trị từ lat/lng. Không làm gì nếu bảng chưa có hoặc đã đủ cột.
+    """
+    inspector = sa_inspect(db.engine)
+    for model in (User, Hospital):
+        table = model.__table__
+        if not inspector.has_table(table.name):
+            continue
+        existing = {c['name'] for c in inspector.get_columns(table.name)}
+        missing = [c for c in UNIT_VECTOR_COLUMNS if c not in existing]
+        if not missing:
+            continue
+        with db.engine.begin() as conn:
+            for column in missing:
+                conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column} FLOAT'))
+            rows = conn.execute(
+                select(table.c.id, table.c.lat, table.c.lng)
+                .where(table.c.lat.isnot(None), table.c.lng.isnot(None))
+            ).all()
+            values = [
+                dict(zip(('row_id', 'ux', 'uy', 'uz'), (row.id, *donor_cache.unit_vector(row.lat, row.lng))))
+                for row in rows
+            ]
+            if values:
+                conn.execute(
+                    update(table)
+                    .where(table.c.id == bindparam('row_id'))
+                    .values(x=bindparam('ux'), y=bindparam('uy'), z=bindparam('uz')),
+                    values
+                )
+        print(f"✅ Đã thêm cột {', '.join(missing)} vào bảng {table.name} ({len(values)} dòng)")
+
+with app.app_context():
+    upgrade_unit_vector_columns()
+
+class GeocodeCache(db.Model):
+    __tablename__ = 'geocode_cache'
+    address_hash = db.Column(db.String(32), primary_key=True)
+    address = db.Column(db.String(200), nullable=False)
+    lat = db.Column(db.Float, nullable=True)  # None = dịch vụ trả lời không tìm thấy
+    lng = db.Column(db.Float, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+# --- GEOCODING CÓ CACHE ---
+
+def normalize_address(address):
+    """Chuẩn hóa địa chỉ (chữ thường, bỏ dấu, gộp khoảng trắng) để làm khóa cache."""
+    text = unicodedata.normalize('NFKD', address.lower())
+    text = ''.join(ch for ch in text if not unicodedata.combining(ch))
+    return ' '.join(text.split())
+
+def address_hash(address):
+    return hashlib.blake2b(normalize_address(address).encode('utf-8'), digest_size=16).hexdigest()
+
+# Kết quả "không tìm thấy" chỉ được tin trong khoảng này rồi thử lại,
+# phòng khi dịch vụ bổ sung dữ liệu hoặc địa chỉ bị từ chối nhầm
+NEGATIVE_CACHE_TTL = timedelta(days=7)
+
+# L2: bảng geocode_cache. Đọc/ghi qua kết nối riêng, transaction ngắn,
+# không đụng tới db.session của request đang chạy
+def _load_cached_coords(keys):
+    """Trả về dict address_hash -> (lat, lng) hoặc None cho các khóa đã có trong cache (bỏ qua dòng None đã hết hạn)."""
+    negative_since = datetime.utcnow() - NEGATIVE_CACHE_TTL
+    with db.engine.connect() as conn:
+        rows = conn.execute(
+            select(GeocodeCache.address_hash, GeocodeCache.lat, GeocodeCache.lng)
+            .where(
+                GeocodeCache.address_hash.in_(list(keys)),
+                or_(GeocodeCache.lat.isnot(None), GeocodeCache.created_at >= negative_since)
+            )
+        ).all()
+    return {r.address_hash: (r.lat, r.lng) if r.lat is not None else None for r in rows}
+
+def _store_cached_coords(entries):
+    """Ghi các cặp (address_hash, address, coords) vào cache, ghi đè dòng cũ (vd. dòng None đã hết hạn)."""
+    now = datetime.utcnow()
+    values = [
+        {'address_hash': key, 'address': address,
+         'lat': coords[0] if coords else None, 'lng': coords[1] if coords else None,
+         'created_at': now}
+        for key, address, coords in entries
+    ]
+    if not values:
+        return
+    stmt = sqlite_insert(GeocodeCache.__table__)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['address_hash'],
+        set_={'lat': stmt.excluded.lat, 'lng': stmt.excluded.lng, 'created_at': stmt.excluded.created_at}
+    )
+    with db.engine.begin() as conn:
+        conn.execute(stmt, values)
+
+# L1: LRU trong tiến trình, chỉ giữ tọa độ tìm thấy (kết quả None cần hết hạn theo L2)
+_GEOCODE_L1 = LRUCache(maxsize=10000)
+_geocode_l1_lock = threading.Lock()  # LRUCache không thread-safe
+
+def cached_geocode_address(address):
+    """
+    Geocode có cache 2 tầng: LRU trong tiến trình (L1) và bảng geocode_cache (L2).
+    Kết quả không tìm thấy được cache ở L2 trong NEGATIVE_CACHE_TTL. Lỗi kết nối
+    (RequestException) được ném ra và không cache gì.
+    """
+    key = address_hash(address)
+    with _geocode_l1_lock:
+        coords = _GEOCODE_L1.get(key)
+    if coords is not None:
+        return coords
+
+    cached = _load_cached_coords([key])
+    if key in cached:
+        coords = cached[key]
+    else:
+        coords = geocode_address(address)
+        _store_cached_coords([(key, address, coords)])
+
+    if coords is not None:
+        with _geocode_l1_lock:
+            _GEOCODE_L1[key] = coords
+    return coords
+
+def cached_geocode_many(addresses):
+    """
+    Geocode hàng loạt có cache: loại trùng theo địa chỉ đã chuẩn hóa, đọc cache
+    một lần, chỉ gọi API cho các địa chỉ chưa có.
+
+    Returns:
+        Dict địa chỉ -> (lat, lng) hoặc None. Địa chỉ gọi dịch vụ bị lỗi cũng là
+        None nhưng không được ghi vào cache, lần sau sẽ geocode lại.
+    """
+    by_key = {}
+    for address in addresses:
+        by_key.setdefault(address_hash(address), address)
+
+    coords_by_key = _load_cached_coords(by_key.keys())
+    missing = {key: address for key, address in by_key.items() if key not in coords_by_key}
+    if missing:
+        fetched = geocode_many(missing.values())
+        new_entries = [
+            (key, address, fetched[address]) for key, address in missing.items() if address in fetched
+        ]
+        _store_cached_coords(new_entries)
+        coords_by_key.update({key: coords for key, _, coords in new_entries})
+
+    return {address: coords_by_key.get(address_hash(address)) for address in addresses}
+
+
+# --- GEOCODING NỀN (CELERY) ---
+
+@celery.task(autoretry_for=(RequestException,), retry_backoff=True, retry_backoff_max=600, max_retries=5)
+def geocode_user(user_id, address):
+    """
+    Geocode địa chỉ ở background rồi ghi tọa độ cho người dùng bằng một UPDATE ngắn.
+    Lỗi kết nối tới dịch vụ geocoding được ném ra để Celery thử lại, không ghi gì;
+    chỉ ghi NULL khi dịch vụ trả lời không tìm thấy.
+    """
+    with app.app_context():
+        coords = cached_geocode_address(address)
+        lat, lng = coords if coords else (None, None)
+        x, y, z = donor_cache.unit_vector(lat, lng)
+        # Bỏ qua nếu người dùng đã đổi sang địa chỉ khác trong lúc chờ
+        db.session.execute(
+            update(User)
+            .where(User.id == user_id, User.address == address)
+            .values(lat=lat, lng=lng, x=x, y=y, z=z)
+        )
+        db.session.commit()
+        donor_cache.invalidate()
+        if coords:
+            print(f"✅ Geocoding thành công cho user {user_id}: '{address}'")
+        else:
+            print(f"⚠️ Không tìm thấy tọa độ cho user {user_id}: '{address}'")
+
+def schedule_geocoding(user_id, address):
+    """
+    Đẩy việc geocode sang Celery. Nếu không gửi được task (broker không chạy)
+    thì geocode trực tiếp để người dùng vẫn có tọa độ.
+
+    Returns:
+        True nếu task đã vào hàng đợi, False nếu đã geocode xong tại chỗ
+    """
+    try:
+        geocode_user.delay(user_id, address)
+        return True
+    except Exception as e:
+        print(f"⚠️ Không gửi được task geocoding ({e}), geocode trực tiếp")
+    try:
+        geocode_user(user_id, address)
+    except RequestException as e:
+        # Chạy tại chỗ thì không có retry của Celery, tọa độ giữ nguyên NULL
+        print(f"❌ Không gọi được dịch vụ geocoding cho user {user_id}: {e}")
+    except Exception as e:
+        print(f"❌ Lỗi khi geocoding: {e}")
+    return False
+
+
+# --- MẬT KHẨU & CACHE ĐĂNG NHẬP ---
+
+# email -> (password hash, user dict) của các lần đăng nhập thành công gần đây
+LOGIN_CACHE = TTLCache(maxsize=10000, ttl=60)
+_login_cache_lock = threading.Lock()  # TTLCache không thread-safe
+
+BCRYPT_ROUNDS = 12
+# Import hàng loạt dùng cost thấp hơn cho nhanh, được nâng lên BCRYPT_ROUNDS ở lần đăng nhập đầu
+BULK_BCRYPT_ROUNDS = 10
+# bcrypt chỉ nhận tối đa 72 byte (bcrypt >= 5 ném ValueError nếu dài hơn)
+MAX_PASSWORD_BYTES = 72
+
+def password_error(password):
+    """Trả về thông báo lỗi nếu mật khẩu không dùng được với bcrypt, None nếu hợp lệ."""
+    if not isinstance(password, str):
+        return 'Mật khẩu phải là chuỗi'
+    if len(password.encode('utf-8')) > MAX_PASSWORD_BYTES:
+        return f'Mật khẩu tối đa {MAX_PASSWORD_BYTES} byte'
+    return None
+
+def hash_password(password, rounds=BCRYPT_ROUNDS):
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
+
+def hash_passwords(passwords, rounds=BULK_BCRYPT_ROUNDS):
+    """Băm nhiều mật khẩu song song; bcrypt nhả GIL nên các thread chạy thật sự đồng thời."""
+    with ThreadPoolExecutor() as pool:
+        return list(pool.map(lambda p: hash_password(p, rounds), passwords))
+
+def _is_bcrypt_hash(stored):
+    return stored.startswith(('$2a$', '$2b$', '$2y$'))
+
+def _needs_rehash(stored):
+    """Plain text (tài khoản cũ) hoặc bcrypt với cost thấp hơn BCRYPT_ROUNDS."""
+    return not _is_bcrypt_hash(stored) or int(stored[4:6]) < BCRYPT_ROUNDS
+
+def check_password(password, stored):
+    """
+    So khớp mật khẩu với giá trị lưu trong DB.
+    Tài khoản tạo trước khi có bcrypt vẫn lưu plain text, so sánh bằng
+    hmac.compare_digest để thời gian không phụ thuộc nội dung.
+    """
+    if password_error(password):
+        return False  # Không thể khớp với một hash bcrypt nào
+    if _is_bcrypt_hash(stored):
+        return bcrypt.checkpw(password.encode('utf-8'), stored.encode('utf-8'))
+    return hmac.compare_digest(password.encode('utf-8'), stored.encode('utf-8'))
+
+def forget_login(email):
+    with _login_cache_lock:
+        LOGIN_CACHE.pop(email, None)
+
+
+def load_donor_rows():
+    """Đọc mọi donor đã có tọa độ để dựng donor_cache."""
+    return db.session.execute(
+        select(
+            User.id, User.lat, User.lng, User.blood_type, User.last_donation,
+            User.x, User.y, User.z
+        ).where(
+            User.role == 'donor',
+            User.lat.isnot(None),
+            User.lng.isnot(None)
+        )
+    ).all()
+
+
+def _exists(column, value):
+    return db.session.query(db.exists().where(column == value)).scalar()
+
+
+# Biên dịch trước kernel haversine (Numba) lúc khởi động,
+# để request /create_alert đầu tiên không phải chờ JIT
+if filter_nearby_users is not None:
+    warm_up_ai_filter()
+
 
 # --- CÁC API ROUTE ---
 
+REQUIRED_REGISTER = frozenset({'fullName', 'email', 'phone', 'password', 'address', 'bloodType'})
+REQUIRED_ALERT = frozenset({'hospital_id', 'blood_type'})
+# Giới hạn kích thước một lô import (băm mật khẩu + geocoding đều tốn thời gian)
+MAX_BULK_DONORS = 1000
+# Các trường phải là chuỗi (dùng làm khóa set, chuẩn hóa địa chỉ, ghi vào cột String)
+STRING_REGISTER_FIELDS = ('fullName', 'email', 'phone', 'address', 'bloodType')
+BLOOD_TYPE_ERROR = f"Nhóm máu không hợp lệ (một trong {', '.join(donor_cache.BLOOD_TYPES)})"
+
 @app.route('/')
 def index():
     return jsonify({'message': 'Blood Donation API is running with FREE Geocoding!'})
 
 @app.route('/users', methods=['GET'])
 def get_users():
-    users = User.query.all()
-    return jsonify({'count': len(users), 'users': [user.to_dict() for user in users]})
+    # Lấy thẳng các cột thay vì đối tượng ORM (không qua identity map),
+    # orjson tự serialize kiểu date sang YYYY-MM-DD nên không cần isoformat() từng dòng
+    users = [dict(zip(_USER_KEYS, row)) for row in db.session.execute(select(*USER_COLS))]
+    return jsonify({'count': len(users), 'users': users})
 
 @app.route('/hospitals', methods=['GET'])
 def get_hospitals():
@@ -90,30 +458,21 @@ def register_donor():
     data = request.get_json()
 
     # Validate required fields
-    required_fields = ['fullName', 'email', 'phone', 'password', 'address', 'bloodType']
-    if not all(field in data and data[field] for field in required_fields):
+    if (not isinstance(data, dict) or not REQUIRED_REGISTER.issubset(data)
+            or not all(data[k] for k in REQUIRED_REGISTER)):
         return jsonify({'error': 'Thiếu thông tin bắt buộc hoặc thông tin rỗng'}), 400
+    if data['bloodType'] not in donor_cache.BLOOD_TYPES:
+        return jsonify({'error': BLOOD_TYPE_ERROR}), 400
+    error = password_error(data['password'])
+    if error:
+        return jsonify({'error': error}), 400
 
     # Check duplicate
-    if User.query.filter((User.email == data['email']) | (User.phone == data['phone'])).first():
+    # Hai truy vấn EXISTS riêng, mỗi cái đi thẳng vào unique index của cột
+    if _exists(User.email, data['email']) or _exists(User.phone, data['phone']):
          return jsonify({'error': 'Email hoặc số điện thoại đã tồn tại'}), 409
 
-    # ===== GEOCODING MIỄN PHÍ =====
     address = data['address']
-    lat, lng = None, None
-    
-    try:
-        coords = geocode_address(address)
-        
-        if coords:
-            lat, lng = coords
-            print(f"✅ Geocoding thành công cho '{address}'")
-        else:
-            print(f"⚠️ Không tìm thấy tọa độ cho '{address}'")
-            print(f"💡 Người dùng vẫn được đăng ký, có thể cập nhật địa chỉ sau")
-            
-    except Exception as e:
-        print(f"❌ Lỗi khi geocoding: {e}")
 
     # Parse last donation date
     last_donation_date = None
@@ -121,7 +480,7 @@ def register_donor():
         date_str = data['lastDonationDate']
         if date_str:
             try:
-                last_donation_date = parse(date_str).date()
+                last_donation_date = date.fromisoformat(date_str)
             except (ValueError, TypeError) as e:
                  print(f"Lỗi parse ngày '{date_str}': {e}")
                  return jsonify({'error': 'Định dạng ngày hiến máu cuối không hợp lệ (cần YYYY-MM-DD)'}), 400
@@ -131,11 +490,11 @@ def register_donor():
         name=data['fullName'],
         email=data['email'],
         phone=data['phone'],
-        password=data['password'],  # TODO: Nên hash password bằng bcrypt
+        password=hash_password(data['password']),
         role='donor',
         address=address,
-        lat=lat,
-        lng=lng,
+        lat=None,  # Tọa độ được điền sau bởi task geocode_user
+        lng=None,
         blood_type=data['bloodType'],
         last_donation=last_donation_date
     )
@@ -143,10 +502,21 @@ def register_donor():
     try:
         db.session.add(new_user)
         db.session.commit()
+
+        # ===== GEOCODING MIỄN PHÍ (chạy nền) =====
+        if schedule_geocoding(new_user.id, address):
+            return jsonify({
+                'message': 'Đăng ký thành công',
+                'warning': 'Đang xác định vị trí (geocoding pending), tọa độ sẽ được cập nhật sau.',
+                'user': new_user.to_dict()
+            }), 202
+
+        # Đã geocode tại chỗ bằng session khác, đọc lại tọa độ vừa ghi
+        db.session.refresh(new_user)
         user_dict = new_user.to_dict()
         
         # Warning if no coordinates
-        if lat is None or lng is None:
+        if user_dict['lat'] is None or user_dict['lng'] is None:
             return jsonify({
                 'message': 'Đăng ký thành công',
                 'warning': 'Không thể xác định vị trí chính xác. Vui lòng kiểm tra lại địa chỉ hoặc cập nhật sau.',
@@ -164,52 +534,184 @@ def register_donor():
         return jsonify({'error': 'Lỗi máy chủ nội bộ khi đăng ký'}), 500
 
 
+@app.route('/register_donors/bulk', methods=['POST'])
+def register_donors_bulk():
+    """Nhập nhiều người hiến máu một lần (dành cho admin import)."""
+    donors = request.get_json()
+    if not isinstance(donors, list) or not donors:
+        return jsonify({'error': 'Cần gửi lên một mảng người hiến máu'}), 400
+    if len(donors) > MAX_BULK_DONORS:
+        return jsonify({'error': f'Tối đa {MAX_BULK_DONORS} người hiến máu mỗi lần'}), 400
+
+    # Validate từng dòng, gom lỗi theo vị trí trong mảng
+    errors = []
+    seen_emails, seen_phones = set(), set()
+    last_donation_dates = []
+    for i, data in enumerate(donors):
+        last_donation_dates.append(None)
+        if (not isinstance(data, dict) or not REQUIRED_REGISTER.issubset(data)
+                or not all(data[k] for k in REQUIRED_REGISTER)):
+            errors.append({'index': i, 'error': 'Thiếu thông tin bắt buộc hoặc thông tin rỗng'})
+            continue
+        if not all(isinstance(data[k], str) for k in STRING_REGISTER_FIELDS):
+            errors.append({'index': i, 'error': 'Các trường thông tin phải là chuỗi'})
+            continue
+        if data['bloodType'] not in donor_cache.BLOOD_TYPES:
+            errors.append({'index': i, 'error': BLOOD_TYPE_ERROR})
+            continue
+        error = password_error(data['password'])
+        if error:
+            errors.append({'index': i, 'error': error})
+            continue
+        if data['email'] in seen_emails or data['phone'] in seen_phones:
+            errors.append({'index': i, 'error': 'Email hoặc số điện thoại bị trùng trong danh sách'})
+            continue
+        seen_emails.add(data['email'])
+        seen_phones.add(data['phone'])
+        if data.get('lastDonationDate'):
+            try:
+                last_donation_dates[i] = date.fromisoformat(data['lastDonationDate'])
+            except (ValueError, TypeError):
+                errors.append({'index': i, 'error': 'Định dạng ngày hiến máu cuối không hợp lệ (cần YYYY-MM-DD)'})
+
+    if errors:
+        return jsonify({'error': 'Dữ liệu không hợp lệ', 'details': errors}), 400
+
+    # Trùng với dữ liệu đã có: 409 như /register_donor
+    existing = db.session.execute(
+        select(User.email, User.phone).where(or_(User.email.in_(seen_emails), User.phone.in_(seen_phones)))
+    ).all()
+    if existing:
+        taken = {v for row in existing for v in row}
+        conflicts = [
+            {'index': i, 'error': 'Email hoặc số điện thoại đã tồn tại'}
+            for i, data in enumerate(donors)
+            if data['email'] in taken or data['phone'] in taken
+        ]
+        return jsonify({'error': 'Email hoặc số điện thoại đã tồn tại', 'details': conflicts}), 409
+
+    # ===== GEOCODING HÀNG LOẠT (trước khi ghi, không giữ khóa ghi trong lúc gọi mạng) =====
+    coords_by_address = cached_geocode_many([data['address'] for data in donors])
+
+    password_hashes = hash_passwords([data['password'] for data in donors])
+
+    rows = []
+    not_geocoded = []
+    for data, last_donation_date, password_hash in zip(donors, last_donation_dates, password_hashes):
+        coords = coords_by_address.get(data['address'])
+        if coords is None:
+            not_geocoded.append(data['email'])
+        # bulk_insert_mappings không chạy event của ORM, tự tính x, y, z
+        x, y, z = donor_cache.unit_vector(*coords) if coords else (None, None, None)
+        rows.append({
+            'name': data['fullName'],
+            'email': data['email'],
+            'phone': data['phone'],
+            'password': password_hash,
+            'role': 'donor',
+            'address': data['address'],
+            'lat': coords[0] if coords else None,
+            'lng': coords[1] if coords else None,
+            'x': x,
+            'y': y,
+            'z': z,
+            'blood_type': data['bloodType'],
+            'last_donation': last_donation_date
+        })
+
+    # Một transaction, một lần fsync cho cả lô
+    try:
+        db.session.bulk_insert_mappings(User, rows)
+        db.session.commit()
+        donor_cache.invalidate()
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({'error': 'Email hoặc số điện thoại đã tồn tại'}), 409
+    except Exception as e:
+        db.session.rollback()
+        print(f"Lỗi database: {e}")
+        return jsonify({'error': 'Lỗi máy chủ nội bộ khi đăng ký'}), 500
+
+    response = {'message': 'Đăng ký thành công', 'count': len(rows)}
+    if not_geocoded:
+        response['warning'] = 'Không thể xác định vị trí cho một số người dùng.'
+        response['not_geocoded'] = not_geocoded
+    return jsonify(response), 201
+
+
 @app.route('/login', methods=['POST'])
 def login():
     data = request.get_json()
     if not data or not data.get('email') or not data.get('password'):
         return jsonify({'error': 'Thiếu email hoặc mật khẩu'}), 400
-    user = User.query.filter_by(email=data['email']).first()
-    if user and user.password == data['password']:
-        user_data = user.to_dict()
-        return jsonify({'message': 'Đăng nhập thành công', 'user': user_data}), 200
-    else:
+    email = data['email']
+
+    with _login_cache_lock:
+        cached = LOGIN_CACHE.get(email)
+    if cached is not None:
+        password_hash, user_data = cached
+        if check_password(data['password'], password_hash):
+            return jsonify({'message': 'Đăng nhập thành công', 'user': user_data}), 200
         return jsonify({'error': 'Email hoặc mật khẩu không chính xác'}), 401
 
+    user = db.session.execute(select(User).where(User.email == email)).scalar_one_or_none()
+    if not user or not check_password(data['password'], user.password):
+        return jsonify({'error': 'Email hoặc mật khẩu không chính xác'}), 401
+
+    # Tài khoản cũ còn lưu plain text hoặc hash cost thấp (import hàng loạt): băm lại ngay khi đăng nhập đúng
+    if _needs_rehash(user.password):
+        try:
+            user.password = hash_password(data['password'])
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print(f"Lỗi khi cập nhật mật khẩu: {e}")
+
+    user_data = user.to_dict()
+    if _is_bcrypt_hash(user.password):
+        with _login_cache_lock:
+            LOGIN_CACHE[email] = (user.password, user_data)
+    return jsonify({'message': 'Đăng nhập thành công', 'user': user_data}), 200
+
 
 @app.route('/create_alert', methods=['POST'])
 def create_alert():
     data = request.get_json()
-    required_alert_fields = ['hospital_id', 'blood_type']
-    if not all(k in data for k in required_alert_fields):
+    if not isinstance(data, dict) or not REQUIRED_ALERT.issubset(data):
         return jsonify({'error': 'Thiếu hospital_id hoặc blood_type'}), 400
     hospital = Hospital.query.get(data['hospital_id'])
     if not hospital:
         return jsonify({'error': 'Không tìm thấy bệnh viện'}), 404
     blood_type_needed = data['blood_type']
     radius_km = data.get('radius_km', 10)
-    suitable_users = User.query.filter(
-        User.role == 'donor',
-        User.lat.isnot(None),
-        User.lng.isnot(None),
-        User.blood_type == blood_type_needed
-    ).all()
+    # bool là con của int nên phải loại riêng; 0 sẽ làm phép chia điểm khoảng cách lỗi
+    if (isinstance(radius_km, bool) or not isinstance(radius_km, (int, float))
+            or not math.isfinite(radius_km) or radius_km <= 0):
+        return jsonify({'error': 'radius_km phải là số dương'}), 400
+    if filter_nearby_users is None:
+        return jsonify({'error': "Không tìm thấy file ai_filter.py hoặc file có lỗi."}), 500
     try:
-        from ai_filter import filter_nearby_users
-        results = filter_nearby_users(hospital, suitable_users, radius_km)
-        top_50_users = results[:50]
+        # Lọc nhóm máu + bán kính (dây cung giữa vector đơn vị) trên cache trong RAM,
+        # không truy vấn SQLite
+        suitable_donors = donor_cache.candidates(
+            load_donor_rows, blood_type_needed, hospital.unit_vector(), radius_km
+        )
+        total_matched, top_50_users = filter_nearby_users(hospital, suitable_donors, radius_km, limit=50)
+        top_ids = [r['id'] for r in top_50_users]
+        users_by_id = {
+            row[0]: dict(zip(_USER_KEYS, row))
+            for row in db.session.execute(select(*USER_COLS).where(User.id.in_(top_ids)))
+        }
         return jsonify({
             'hospital': hospital.to_dict(),
             'blood_type_needed': blood_type_needed,
             'radius_km': radius_km,
-            'total_matched': len(results),
+            'total_matched': total_matched,
             'top_50_users': [
-                {'user': r['user'].to_dict(), 'distance_km': r['distance'], 'ai_score': r['ai_score']}
+                {'user': users_by_id[r['id']], 'distance_km': r['distance'], 'ai_score': r['ai_score']}
                 for r in top_50_users
             ]
         })
-    except ImportError:
-        return jsonify({'error': "Không tìm thấy file ai_filter.py hoặc file có lỗi."}), 500
     except Exception as e:
         print(f"Lỗi trong quá trình lọc AI: {e}")
         return jsonify({'error': 'Lỗi máy chủ nội bộ khi lọc người dùng'}), 500
@@ -229,45 +731,52 @@ def update_user_profile(user_id):
                 date_str = data[field]
                 if date_str:
                     try:
-                        setattr(user, field, parse(date_str).date())
+                        setattr(user, field, date.fromisoformat(date_str))
                     except (ValueError, TypeError):
                         return jsonify({'error': f'Định dạng ngày {field} không hợp lệ'}), 400
                 else:
                      setattr(user, field, None)
+            elif field == 'blood_type' and data[field] is not None and data[field] not in donor_cache.BLOOD_TYPES:
+                return jsonify({'error': BLOOD_TYPE_ERROR}), 400
             else:
                  setattr(user, field, data[field])
             if field == 'address' and data[field] != old_address:
                 geocoding_needed = True
 
-    # Geocode if address changed
-    if geocoding_needed and user.address:
-        print(f"\n🔄 ĐANG CẬP NHẬT TỌA ĐỘ")
-        print(f"   Địa chỉ cũ: {old_address}")
-        print(f"   Địa chỉ mới: {user.address}")
-        
-        try:
-            coords = geocode_address(user.address)
-            if coords:
-                user.lat, user.lng = coords
-                print(f"✅ Cập nhật tọa độ thành công!")
-            else:
-                user.lat = None
-                user.lng = None
-                print(f"⚠️ Không tìm thấy tọa độ cho địa chỉ mới")
-        except Exception as e:
-            print(f"❌ Lỗi khi geocode: {e}")
+    # Tọa độ cũ không còn đúng với địa chỉ mới, sẽ được geocode lại ở background
+    if geocoding_needed:
+        user.lat = None
+        user.lng = None
 
     try:
         db.session.commit()
-        return jsonify({'message': 'Cập nhật thông tin thành công', 'user': user.to_dict()}), 200
     except Exception as e:
         db.session.rollback()
         print(f"Lỗi khi cập nhật database: {e}")
         return jsonify({'error': 'Lỗi máy chủ nội bộ khi cập nhật'}), 500
+    forget_login(user.email)
+    donor_cache.invalidate()
+
+    # Geocode if address changed
+    if geocoding_needed and user.address:
+        print(f"\n🔄 ĐANG CẬP NHẬT TỌA ĐỘ")
+        print(f"   Địa chỉ cũ: {old_address}")
+        print(f"   Địa chỉ mới: {user.address}")
+        
+        if schedule_geocoding(user.id, user.address):
+            return jsonify({
+                'message': 'Cập nhật thông tin thành công',
+                'warning': 'Đang xác định vị trí (geocoding pending), tọa độ sẽ được cập nhật sau.',
+                'user': user.to_dict()
+            }), 202
+        # Đã geocode tại chỗ bằng session khác, đọc lại tọa độ vừa ghi
+        db.session.refresh(user)
+
+    return jsonify({'message': 'Cập nhật thông tin thành công', 'user': user.to_dict()}), 200
 
 
 # --- CHẠY ỨNG DỤNG ---
 if __name__ == '__main__':
     with app.app_context():
         db.create_all()
-    app.run(debug=True, port=5000)
\ No newline at end of file
+    app.run(debug=True, port=5000)
\ No newline at end of file
@@ -0,0 +1,181 @@
+"""
+donor_cache.py
+Cache tọa độ người hiến máu trong RAM dạng Structure-of-Arrays (mỗi cột một mảng
+NumPy liên tục) để /create_alert lọc bằng mask vector hóa mà không phải đọc lại
+SQLite ở mỗi request.
+
+Ngoài lat/lng, mỗi điểm còn có vector đơn vị (x, y, z) trên mặt cầu: hai điểm
+cách nhau d km khi và chỉ khi khoảng cách Euclid (dây cung) giữa hai vector là
+2*sin(d / 2R), nên lọc theo bán kính chỉ cần cộng/nhân, không cần lượng giác.
+Khi có scipy, các vector được dựng thành k-d tree để truy vấn bán kính chỉ
+chạm tới O(k + log N) điểm thay vì quét cả N.
+"""
+
+import math
+import threading
+import time
+from typing import Any, Callable, NamedTuple
+
+import numpy as np
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:  # Không có scipy: quét tuyến tính trên mảng
+    cKDTree = None
+
+# Cache tự dựng lại sau khoảng này, để thấy cả thay đổi từ tiến trình khác
+# (Celery worker, worker web khác) vốn không gọi được invalidate() của tiến trình này
+MAX_AGE_SECONDS = 60
+
+# last_donation lưu dạng date.toordinal(); 0 = chưa hiến bao giờ
+NO_DONATION = 0
+
+EARTH_RADIUS_KM = 6371.0
+
+# Các nhóm máu hợp lệ, mã hóa cố định 1..8; 0 = giá trị khác (dữ liệu cũ không hợp lệ)
+BLOOD_TYPES = ('O+', 'O-', 'A+', 'A-', 'B+', 'B-', 'AB+', 'AB-')
+BLOOD_CODES = {bt: code for code, bt in enumerate(BLOOD_TYPES, start=1)}
+OTHER_BLOOD = 0
+
+
+def unit_vector(lat, lng):
+    """Vector đơn vị (x, y, z) của tọa độ (độ), hoặc (None, None, None) nếu thiếu tọa độ."""
+    if lat is None or lng is None:
+        return (None, None, None)
+    lat_rad, lng_rad = math.radians(lat), math.radians(lng)
+    return (
+        math.cos(lat_rad) * math.cos(lng_rad),
+        math.cos(lat_rad) * math.sin(lng_rad),
+        math.sin(lat_rad)
+    )
+
+
+def chord_threshold(radius_km):
+    """Bình phương dây cung (trên mặt cầu đơn vị) ứng với bán kính radius_km."""
+    if radius_km >= math.pi * EARTH_RADIUS_KM:
+        return 4.0  # Cả địa cầu
+    return (2 * math.sin(radius_km / (2 * EARTH_RADIUS_KM))) ** 2
+
+
+class DonorArrays(NamedTuple):
+    id: np.ndarray             # int64
+    lat: np.ndarray            # float32
+    lng: np.ndarray            # float32
+    blood: np.ndarray          # uint8, mã hóa qua BLOOD_CODES
+    last_donation: np.ndarray  # int32 ordinal
+    x: np.ndarray              # float32, vector đơn vị
+    y: np.ndarray              # float32
+    z: np.ndarray              # float32
+    tree: Any = None           # cKDTree trên (x, y, z), None nếu không có scipy
+
+    def take(self, index):
+        return DonorArrays(
+            self.id[index], self.lat[index], self.lng[index],
+            self.blood[index], self.last_donation[index],
+            self.x[index], self.y[index], self.z[index]
+        )
+
+
+_EMPTY = DonorArrays(
+    np.empty(0, dtype=np.int64),
+    np.empty(0, dtype=np.float32),
+    np.empty(0, dtype=np.float32),
+    np.empty(0, dtype=np.uint8),
+    np.empty(0, dtype=np.int32),
+    np.empty(0, dtype=np.float32),
+    np.empty(0, dtype=np.float32),
+    np.empty(0, dtype=np.float32)
+)
+
+_lock = threading.Lock()
+_donors = _EMPTY
+_dirty = True
+_built_at = 0.0
+
+
+def invalidate():
+    """Đánh dấu cache cũ, lần đọc tiếp theo sẽ dựng lại."""
+    global _dirty
+    _dirty = True
+
+
+def _pack(rows) -> DonorArrays:
+    """Đóng gói các dòng (id, lat, lng, blood_type, last_donation, x, y, z) thành các mảng NumPy."""
+    n = len(rows)
+    lat = np.fromiter((r[1] for r in rows), dtype=np.float32, count=n)
+    lng = np.fromiter((r[2] for r in rows), dtype=np.float32, count=n)
+    xyz = [
+        np.fromiter((np.nan if r[i] is None else r[i] for r in rows), dtype=np.float32, count=n)
+        for i in (5, 6, 7)
+    ]
+    # Dòng cũ chưa có x, y, z (tạo trước khi thêm cột): tính từ lat/lng
+    missing = np.isnan(xyz[0])
+    if missing.any():
+        lat_rad = np.radians(lat[missing].astype(np.float64))
+        lng_rad = np.radians(lng[missing].astype(np.float64))
+        xyz[0][missing] = np.cos(lat_rad) * np.cos(lng_rad)
+        xyz[1][missing] = np.cos(lat_rad) * np.sin(lng_rad)
+        xyz[2][missing] = np.sin(lat_rad)
+    tree = None
+    if cKDTree is not None and n > 0:
+        tree = cKDTree(np.column_stack(xyz))
+    return DonorArrays(
+        np.fromiter((r[0] for r in rows), dtype=np.int64, count=n),
+        lat,
+        lng,
+        np.fromiter((BLOOD_CODES.get(r[3], OTHER_BLOOD) for r in rows), dtype=np.uint8, count=n),
+        np.fromiter(
+            (r[4].toordinal() if r[4] else NO_DONATION for r in rows),
+            dtype=np.int32, count=n
+        ),
+        xyz[0], xyz[1], xyz[2],
+        tree
+    )
+
+
+def get(load_rows: Callable[[], list]) -> DonorArrays:
+    """
+    Trả về snapshot hiện tại, dựng lại bằng load_rows() nếu đã bị invalidate hoặc quá cũ.
+
+    Args:
+        load_rows: Hàm trả về các dòng (id, lat, lng, blood_type, last_donation, x, y, z)
+                   của mọi donor đã có tọa độ
+    """
+    global _donors, _dirty, _built_at
+    if not _dirty and time.monotonic() - _built_at < MAX_AGE_SECONDS:
+        return _donors
+    with _lock:
+        if _dirty or time.monotonic() - _built_at >= MAX_AGE_SECONDS:
+            # Hạ cờ trước khi đọc: ghi nào xảy ra trong lúc dựng sẽ bật lại cờ
+            _dirty = False
+            try:
+                _donors = _pack(load_rows())
+            except Exception:
+                _dirty = True
+                raise
+            _built_at = time.monotonic()
+        return _donors
+
+
+def candidates(load_rows, blood_type, anchor_xyz, radius_km) -> DonorArrays:
+    """
+    Lọc các donor đúng nhóm máu nằm trong bán kính radius_km quanh điểm neo,
+    so sánh bình phương dây cung giữa các vector đơn vị (không cần lượng giác).
+    """
+    donors = get(load_rows)
+    if blood_type not in BLOOD_TYPES:  # so sánh bằng ==, không lỗi nếu blood_type không hash được
+        return _EMPTY
+    code = BLOOD_CODES[blood_type]
+    threshold = chord_threshold(radius_km)
+
+    if donors.tree is not None:
+        # Chỉ những điểm trong hình cầu bán kính = dây cung, rồi mới lọc nhóm máu
+        index = np.asarray(donors.tree.query_ball_point(anchor_xyz, r=math.sqrt(threshold)), dtype=np.intp)
+        index.sort()  # Giữ thứ tự như khi quét tuyến tính
+        return donors.take(index[donors.blood[index] == code])
+
+    hx, hy, hz = (np.float32(v) for v in anchor_xyz)
+    dx, dy, dz = donors.x - hx, donors.y - hy, donors.z - hz
+    mask = donors.blood == code
+    mask &= dx * dx + dy * dy + dz * dz <= np.float32(threshold)
+    return donors.take(np.flatnonzero(mask))
@@ -0,0 +1,53 @@
+"""
+fast_haversine.py
+Kernel haversine biên dịch bằng Numba cho /create_alert
+"""
+
+import math
+import numpy as np
+from numba import njit
+
+EARTH_RADIUS_KM = 6371.0
+
+# Hằng số float32: tránh để phép tính trong kernel bị nâng lên float64
+_DEG2RAD = np.float32(math.pi / 180)
+_TWO_R = np.float32(2 * EARTH_RADIUS_KM)
+_HALF = np.float32(0.5)
+_ONE = np.float32(1.0)
+
+
+# Không dùng parallel=True: kernel được gọi từ nhiều thread của Flask, và
+# threading layer workqueue (mặc định khi thiếu TBB/OpenMP) abort khi bị gọi đồng
+# thời. Mảng vào chỉ gồm donor đã lọc theo bán kính nên chạy một luồng là đủ
+@njit(fastmath=True, cache=True)
+def _haversine_kernel(lats, lngs, hlat_rad, hlng_rad, out):
+    cos_hlat = math.cos(hlat_rad)
+    for i in range(lats.shape[0]):
+        lat1 = lats[i] * _DEG2RAD
+        sin_dlat = math.sin((lat1 - hlat_rad) * _HALF)
+        sin_dlng = math.sin((lngs[i] * _DEG2RAD - hlng_rad) * _HALF)
+        a = sin_dlat * sin_dlat + cos_hlat * math.cos(lat1) * sin_dlng * sin_dlng
+        # fastmath có thể làm a vượt 1 một chút, chặn lại để asin không ra NaN
+        out[i] = _TWO_R * math.asin(math.sqrt(min(a, _ONE)))
+    return out
+
+
+def haversine_to_anchor(lats, lngs, hlat, hlng, out):
+    """
+    Tính khoảng cách (km) từ từng điểm (lats[i], lngs[i]) tới điểm neo (hlat, hlng)
+    trong một lượt duyệt, ghi thẳng vào mảng out.
+
+    Điểm neo được ép về cùng dtype với lats, nên mảng float32 được tính
+    hoàn toàn bằng float32 (gấp đôi số phần tử mỗi lệnh SIMD).
+
+    Returns:
+        Chính mảng out
+    """
+    ftype = lats.dtype.type
+    return _haversine_kernel(lats, lngs, ftype(hlat) * _DEG2RAD, ftype(hlng) * _DEG2RAD, out)
+
+
+def warm_up():
+    """Gọi kernel với mảng 1 phần tử để Numba biên dịch trước khi có request."""
+    one = np.zeros(1, dtype=np.float32)
+    haversine_to_anchor(one, one, 0.0, 0.0, np.empty(1, dtype=np.float32))
@@ -1,20 +1,60 @@
 """
 geocoding_free.py
 Geocoding HOÀN TOÀN MIỄN PHÍ cho địa chỉ Việt Nam
+
+Các hàm đồng bộ dùng chung một requests.Session (_SESSION): kết nối HTTPS tới
+Photon/Nominatim được giữ lại (keep-alive) giữa các lần gọi, nên chỉ lần đầu
+mới tốn bắt tay TCP+TLS. Session chỉ được dùng chung để giữ kết nối; mọi
+request đều là GET không trạng thái (không dựa vào cookie hay header của session).
 """
 
+import asyncio
+import aiohttp
 import requests
 import time
-from typing import Optional, Tuple
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from typing import Dict, Iterable, Optional, Tuple
+
+# Số request Photon chạy song song khi geocode hàng loạt
+PHOTON_CONCURRENCY = 8
+# Nominatim cho phép tối đa 1 request/giây
+OSM_MIN_INTERVAL = 1.0
+
+_SESSION = requests.Session()
+_SESSION.mount('https://', HTTPAdapter(
+    pool_connections=8,
+    pool_maxsize=32,
+    # Thử lại lỗi tạm thời (mất kết nối, 429, 5xx) với backoff ngắn
+    max_retries=Retry(
+        total=2,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset({'GET'}),
+        raise_on_status=False
+    )
+))
+
+
+def _raise_for_transient(response: requests.Response) -> None:
+    """429/5xx là lỗi tạm thời của dịch vụ, không phải "không tìm thấy" -> ném lỗi để gọi lại sau"""
+    if response.status_code == 429 or response.status_code >= 500:
+        response.raise_for_status()
 
 
 def geocode_photon(address: str) -> Optional[Tuple[float, float]]:
-    """Sử dụng Photon API từ Komoot (miễn phí, nhanh)"""
+    """
+    Sử dụng Photon API từ Komoot (miễn phí, nhanh)
+
+    Raises:
+        requests.RequestException nếu không gọi được API (mất mạng, timeout, 429, 5xx)
+    """
+    url = "https://photon.komoot.io/api/"
+    params = {'q': f"{address}, Vietnam", 'limit': 1, 'lang': 'en'}
+    response = _SESSION.get(url, params=params, timeout=10)
+    _raise_for_transient(response)
+
     try:
-        url = "https://photon.komoot.io/api/"
-        params = {'q': f"{address}, Vietnam", 'limit': 1, 'lang': 'en'}
-        response = requests.get(url, params=params, timeout=10)
-        
         if response.status_code == 200:
             data = response.json()
             if 'features' in data and len(data['features']) > 0:
@@ -22,23 +62,29 @@ def geocode_photon(address: str) -> Optional[Tuple[float, float]]:
                 lng, lat = coords[0], coords[1]
                 return (lat, lng)
         return None
-    except:
+    except (ValueError, KeyError, IndexError, TypeError):
         return None
 
 
 def geocode_osm(address: str) -> Optional[Tuple[float, float]]:
-    """Sử dụng OpenStreetMap Nominatim"""
+    """
+    Sử dụng OpenStreetMap Nominatim
+
+    Raises:
+        requests.RequestException nếu không gọi được API (mất mạng, timeout, 429, 5xx)
+    """
+    url = "https://nominatim.openstreetmap.org/search"
+    params = {
+        'q': f"{address}, Vietnam",
+        'format': 'json',
+        'limit': 1,
+        'countrycodes': 'vn'
+    }
+    headers = {'User-Agent': 'BloodDonationApp/1.0'}
+    response = _SESSION.get(url, params=params, headers=headers, timeout=10)
+    _raise_for_transient(response)
+
     try:
-        url = "https://nominatim.openstreetmap.org/search"
-        params = {
-            'q': f"{address}, Vietnam",
-            'format': 'json',
-            'limit': 1,
-            'countrycodes': 'vn'
-        }
-        headers = {'User-Agent': 'BloodDonationApp/1.0'}
-        response = requests.get(url, params=params, headers=headers, timeout=10)
-        
         if response.status_code == 200:
             data = response.json()
             if data and len(data) > 0:
@@ -46,7 +92,7 @@ def geocode_osm(address: str) -> Optional[Tuple[float, float]]:
                 lng = float(data[0]['lon'])
                 return (lat, lng)
         return None
-    except:
+    except (ValueError, KeyError, IndexError, TypeError):
         return None
 
 
@@ -58,7 +104,11 @@ def geocode_address(address: str) -> Optional[Tuple[float, float]]:
         address: Địa chỉ cần geocode
         
     Returns:
-        Tuple (lat, lng) hoặc None nếu không tìm thấy
+        Tuple (lat, lng) hoặc None nếu cả hai dịch vụ đều trả lời là không tìm thấy
+
+    Raises:
+        requests.RequestException nếu không có kết quả và ít nhất một dịch vụ
+        không gọi được (chưa thể kết luận là địa chỉ không tồn tại)
     """
     if not address or not address.strip():
         print("❌ Địa chỉ rỗng")
@@ -71,7 +121,12 @@ def geocode_address(address: str) -> Optional[Tuple[float, float]]:
     
     # Thử Photon trước
     print("\n🔍 [1/2] Đang thử Photon API...")
-    result = geocode_photon(address)
+    error = None
+    try:
+        result = geocode_photon(address)
+    except requests.RequestException as e:
+        print(f"   ❌ Lỗi kết nối: {e}")
+        error, result = e, None
     if result:
         lat, lng = result
         print(f"   ✅ THÀNH CÔNG!")
@@ -85,7 +140,11 @@ def geocode_address(address: str) -> Optional[Tuple[float, float]]:
     
     # Thử OpenStreetMap
     print("\n🔍 [2/2] Đang thử OpenStreetMap...")
-    result = geocode_osm(address)
+    try:
+        result = geocode_osm(address)
+    except requests.RequestException as e:
+        print(f"   ❌ Lỗi kết nối: {e}")
+        error, result = e, None
     if result:
         lat, lng = result
         print(f"   ✅ THÀNH CÔNG!")
@@ -95,11 +154,141 @@ def geocode_address(address: str) -> Optional[Tuple[float, float]]:
     else:
         print(f"   ⚠️ Không tìm thấy")
     
+    if error is not None:
+        print(f"\n❌ THẤT BẠI - Không gọi được dịch vụ geocoding")
+        print(f"{'='*70}\n")
+        raise error
+
     print(f"\n❌ THẤT BẠI - Không tìm thấy tọa độ")
     print(f"{'='*70}\n")
     return None
 
 
+# Lỗi mạng/timeout/429/5xx khi gọi bằng aiohttp: chưa kết luận được là không tìm thấy
+ASYNC_TRANSPORT_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError)
+
+
+def _raise_for_transient_async(response: aiohttp.ClientResponse) -> None:
+    if response.status == 429 or response.status >= 500:
+        response.raise_for_status()
+
+
+async def _geocode_photon_async(session: aiohttp.ClientSession, address: str) -> Optional[Tuple[float, float]]:
+    """Bản async của geocode_photon, dùng chung một ClientSession. Ném ASYNC_TRANSPORT_ERRORS nếu không gọi được."""
+    url = "https://photon.komoot.io/api/"
+    params = {'q': f"{address}, Vietnam", 'limit': 1, 'lang': 'en'}
+    async with session.get(url, params=params) as response:
+        _raise_for_transient_async(response)
+        if response.status != 200:
+            return None
+        try:
+            data = await response.json(content_type=None)
+        except ValueError:  # 200 nhưng không phải JSON (vd. trang bảo trì): coi như không tìm thấy
+            return None
+    try:
+        if 'features' in data and len(data['features']) > 0:
+            coords = data['features'][0]['geometry']['coordinates']
+            lng, lat = coords[0], coords[1]
+            return (lat, lng)
+        return None
+    except (KeyError, IndexError, TypeError):
+        return None
+
+
+async def _geocode_osm_async(session: aiohttp.ClientSession, address: str) -> Optional[Tuple[float, float]]:
+    """Bản async của geocode_osm, dùng chung một ClientSession. Ném ASYNC_TRANSPORT_ERRORS nếu không gọi được."""
+    url = "https://nominatim.openstreetmap.org/search"
+    params = {
+        'q': f"{address}, Vietnam",
+        'format': 'json',
+        'limit': 1,
+        'countrycodes': 'vn'
+    }
+    async with session.get(url, params=params) as response:
+        _raise_for_transient_async(response)
+        if response.status != 200:
+            return None
+        try:
+            data = await response.json(content_type=None)
+        except ValueError:
+            return None
+    try:
+        if data and len(data) > 0:
+            lat = float(data[0]['lat'])
+            lng = float(data[0]['lon'])
+            return (lat, lng)
+        return None
+    except (KeyError, IndexError, TypeError, ValueError):
+        return None
+
+
+async def geocode_many_async(addresses: Iterable[str]) -> Dict[str, Optional[Tuple[float, float]]]:
+    """
+    Geocode nhiều địa chỉ đồng thời trên một connection pool.
+
+    Photon chạy song song (tối đa PHOTON_CONCURRENCY request), địa chỉ nào
+    Photon không tìm thấy mới chuyển sang Nominatim, xếp hàng qua Semaphore
+    để không vượt quá 1 request/giây. Địa chỉ không có kết quả mà có dịch vụ
+    gọi lỗi sẽ không có mặt trong dict trả về.
+    """
+    photon_slots = asyncio.Semaphore(PHOTON_CONCURRENCY)
+    osm_slot = asyncio.Semaphore(1)
+    timeout = aiohttp.ClientTimeout(total=10)
+    headers = {'User-Agent': 'BloodDonationApp/1.0'}
+
+    async with aiohttp.ClientSession(timeout=timeout, headers=headers) as session:
+        async def geocode_one(address):
+            error = None
+            try:
+                async with photon_slots:
+                    result = await _geocode_photon_async(session, address)
+                if result:
+                    return result
+            except ASYNC_TRANSPORT_ERRORS as e:
+                error = e
+            try:
+                async with osm_slot:
+                    try:
+                        result = await _geocode_osm_async(session, address)
+                    finally:
+                        await asyncio.sleep(OSM_MIN_INTERVAL)
+                if result:
+                    return result
+            except ASYNC_TRANSPORT_ERRORS as e:
+                error = e
+            if error is not None:
+                raise error
+            return None
+
+        addresses = list(addresses)
+        results = await asyncio.gather(*(geocode_one(a) for a in addresses), return_exceptions=True)
+
+    found = {}
+    for address, result in zip(addresses, results):
+        if isinstance(result, ASYNC_TRANSPORT_ERRORS):
+            print(f"   ❌ Không gọi được dịch vụ geocoding cho '{address}': {result!r}")
+        elif isinstance(result, BaseException):
+            raise result
+        else:
+            found[address] = result
+    return found
+
+
+def geocode_many(addresses: Iterable[str]) -> Dict[str, Optional[Tuple[float, float]]]:
+    """
+    Geocode hàng loạt địa chỉ (đã loại trùng), gọi được từ code đồng bộ như Flask handler
+
+    Returns:
+        Dict địa chỉ -> (lat, lng) hoặc None nếu không tìm thấy. Địa chỉ gọi
+        dịch vụ bị lỗi không có trong dict (không được coi là không tìm thấy).
+    """
+    unique = list(dict.fromkeys(a for a in addresses if a and a.strip()))
+    if not unique:
+        return {}
+    print(f"\n🔍 GEOCODING HÀNG LOẠT: {len(unique)} địa chỉ")
+    return asyncio.run(geocode_many_async(unique))
+
+
 # Test
 if __name__ == "__main__":
     print("\n🧪 TEST GEOCODING\n")